@@ -1,16 +1,51 @@
 import json
 import logging
 import re
-import hashlib
-import ast
-from typing import Any, Dict, List, TypedDict, Literal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import operator
+from typing import Annotated, Any, Dict, List, Optional, Set, Tuple, TypedDict, Literal
 
+import numpy as np
+import orjson
 from langchain_ollama import ChatOllama
+from langchain_core.caches import InMemoryCache
+from langchain_core.embeddings import Embeddings
 from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage, BaseMessage
 from langgraph.graph import StateGraph, END
 
+from tools import QUERY_TEMPLATES
+
 logger = logging.getLogger(__name__)
 
+class _LockedInMemoryCache(InMemoryCache):
+    # InMemoryCache's evict-then-insert isn't thread-safe (concurrent updates
+    # can evict the same key and raise KeyError); the executor's worker
+    # threads and every Streamlit session share this cache.
+    def __init__(self, *, maxsize: Optional[int] = None) -> None:
+        super().__init__(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def lookup(self, prompt: str, llm_string: str):
+        with self._lock:
+            return super().lookup(prompt, llm_string)
+
+    def update(self, prompt: str, llm_string: str, return_val) -> None:
+        with self._lock:
+            super().update(prompt, llm_string, return_val)
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            super().clear(**kwargs)
+
+# Exact-match response cache shared across agents; keyed on model params + prompt.
+_LLM_RESPONSE_CACHE = _LockedInMemoryCache(maxsize=256)
+
+# (llm_model, temperature, tool names) -> (llm, llm_with_tools)
+_LLM_REGISTRY: Dict[Tuple[str, float, Tuple[str, ...]], Tuple[ChatOllama, Any]] = {}
+_LLM_REGISTRY_LOCK = threading.Lock()
+
 # --- Prompts ---
 PLANNER_SYSTEM_PROMPT = """You are a planning assistant.
 Write 2-4 atomic sub-questions to search for.
@@ -36,22 +71,49 @@ CRITICAL RULES:
 4. If the evidence does not contain the answer, state that clearly. Do not make things up.
 """
 
+# Prompt fragments rendered per chunk.
+_SUMMARY_LINE = "- {}..."
+_EVIDENCE_BLOCK = "[{source}, p. {page}]\n{content}"
+_EVIDENCE_BLOCK_NO_PAGE = "[{source}]\n{content}"
+
+# Sub-questions at least this similar (cosine) to one already asked are dropped.
+SUBQUESTION_SIMILARITY_THRESHOLD = 0.92
+
+# Evidence window the critic judges.
+CRITIC_EVIDENCE_CHARS = 15_000
+
+# Critic notes for a RETRY that can't be acted on; notes stop streaming early.
+RETRIES_EXHAUSTED_NOTE = "Retries exhausted; answering with the evidence gathered so far."
+
 # --- State ---
 class AgentState(TypedDict, total=False):
     user_query: str
     chat_history: List[BaseMessage]
     subquestions: List[str]
-    tool_trace: List[str]
-    evidence_chunks: List[Dict[str, Any]] 
+    subquestions_history: Annotated[List[str], operator.add]  # every sub-question already executed
+    # Append-only: nodes return just their new entries.
+    tool_trace: Annotated[List[str], operator.add]
+    evidence_chunks: Annotated[List[Dict[str, Any]], operator.add]
     retrieved_text: str 
+    rendered_count: int  # newest evidence_chunks that made it into retrieved_text
+    critic_view: str  # newest evidence, capped at CRITIC_EVIDENCE_CHARS
     critic_status: str
     critic_notes: str
     retry_count: int
     final_answer: str
 
+# (tool_call_id, output for the ToolMessage, chunks or None, trace entries)
+ToolResult = Tuple[str, str, Optional[List[Dict[str, Any]]], List[str]]
+# (source, page, content)
+ChunkKey = Tuple[Any, Any, Any]
+
 # --- Helpers ---
+_CODE_FENCE = re.compile(r"```(?:json\s*)?")
+_JSON_OBJ = re.compile(r"\{.*?\}", re.DOTALL)
+_CRITIC_STATUS = re.compile(r"""["']status["']\s*:\s*["'](OK|RETRY)["']""", re.IGNORECASE)
+
 def _parse_json_list(text: str) -> List[str]:
-    text = re.sub(r"```json\s*", "", text).replace("```", "").strip()
+    text = _CODE_FENCE.sub("", text).strip()
     try:
         data = json.loads(text)
         if isinstance(data, list):
@@ -61,14 +123,20 @@ def _parse_json_list(text: str) -> List[str]:
     return []
 
 def _parse_critic_output(text: str) -> Dict[str, str]:
-    text = re.sub(r"```json\s*", "", text).replace("```", "").strip()
-    match = re.search(r"\{.*?\}", text, re.DOTALL)
+    text = _CODE_FENCE.sub("", text).strip()
+    match = _JSON_OBJ.search(text)
     clean = match.group(0) if match else text
     
-    try: return json.loads(clean)
-    except: pass
-    try: return ast.literal_eval(clean)
-    except: pass
+    # Only object-shaped text is worth parsing; the second attempt tolerates
+    # the single-quoted dicts some models emit.
+    if clean.startswith("{") and clean.endswith("}"):
+        for candidate in (clean, clean.replace("'", '"')):
+            try:
+                data = json.loads(candidate)
+            except ValueError:
+                continue
+            if isinstance(data, dict):
+                return data
     
     status = "RETRY" if "retry" in text.lower() else "OK"
     return {"status": status, "notes": text}
@@ -76,14 +144,70 @@ def _parse_critic_output(text: str) -> Dict[str, str]:
 def _tool_map(tools: List[Any]) -> Dict[str, Any]:
     return {t.name: t for t in tools}
 
-def _compute_chunk_hash(chunk: Dict[str, Any]) -> str:
-    raw = f"{chunk.get('source')}||{chunk.get('page')}||{chunk.get('content')}"
-    return hashlib.sha256(raw.encode()).hexdigest()
+def _tool_call_id(tc: Dict[str, Any]) -> str:
+    return tc.get("id") or tc.get("tool_call_id") or tc.get("name")
+
+def _is_batchable(tc: Dict[str, Any]) -> bool:
+    return tc.get("name") in QUERY_TEMPLATES and isinstance(tc.get("args", {}).get("query"), str)
+
+def _extract_chunks(data: List[Any]) -> List[Dict[str, Any]]:
+    # Accepts plain chunk lists as well as batch_search's {"query", "results"} groups.
+    chunks = []
+    for item in data:
+        if not isinstance(item, dict): continue
+        if isinstance(item.get("results"), list):
+            chunks.extend(c for c in item["results"] if isinstance(c, dict))
+        else:
+            chunks.append(item)
+    return chunks
+
+def _chunk_key(chunk: Dict[str, Any]) -> ChunkKey:
+    # Exact dedup key; tuple hashing reuses each str's cached hash, no encoding.
+    return (chunk.get("source"), chunk.get("page"), chunk.get("content"))
+
+def _render_evidence(chunks: List[Dict[str, Any]], max_chars: int) -> Tuple[str, int]:
+    # Tagged evidence blocks for the critic/final prompts, filled newest-first
+    # so chunks found on a retry always get in; rendered in gathered order.
+    # Returns the text and how many of the newest chunks it holds (the full
+    # list stays in evidence_chunks).
+    parts = []
+    total = 0
+    for c in reversed(chunks):
+        if total >= max_chars:
+            break
+        pg = c.get("page")
+        template = _EVIDENCE_BLOCK if pg else _EVIDENCE_BLOCK_NO_PAGE
+        part = template.format(source=c.get("source", "unknown"), page=pg, content=c.get("content", ""))
+        parts.append(part)
+        total += len(part) + 2
+    return "\n\n".join(reversed(parts)), len(parts)
+
+def _get_llms(tools: List[Any], llm_model: str, temperature: float) -> Tuple[ChatOllama, Any]:
+    # The tool binding only carries tool schemas (the executor runs the tools
+    # itself), so the model + binding can be shared across build_agent calls
+    # even when the tools close over a fresh retriever.
+    key = (llm_model, temperature, tuple(t.name for t in tools))
+    with _LLM_REGISTRY_LOCK:
+        if key not in _LLM_REGISTRY:
+            # Only deterministic (temperature 0) generations are safe to replay.
+            llm = ChatOllama(
+                model=llm_model,
+                temperature=temperature,
+                cache=_LLM_RESPONSE_CACHE if temperature == 0 else False,
+            )
+            _LLM_REGISTRY[key] = (llm, llm.bind_tools(tools))
+        return _LLM_REGISTRY[key]
 
 # --- Graph ---
-def build_agent(tools: List[Any], llm_model: str, temperature: float, max_retries: int = 2):
-    llm = ChatOllama(model=llm_model, temperature=temperature)
-    llm_with_tools = llm.bind_tools(tools)
+def build_agent(
+    tools: List[Any],
+    llm_model: str,
+    temperature: float,
+    max_retries: int = 2,
+    max_evidence_chars: int = 32_000,
+    embeddings: Optional[Embeddings] = None,
+):
+    llm, llm_with_tools = _get_llms(tools, llm_model, temperature)
     tools_by_name = _tool_map(tools)
     graph = StateGraph(AgentState)
 
@@ -92,7 +216,7 @@ def build_agent(tools: List[Any], llm_model: str, temperature: float, max_retrie
         history = state.get("chat_history", [])
         critic_notes = state.get("critic_notes", "")
         
-        hist_text = "\n".join([f"{m.type}: {m.content}" for m in history[-4:]])
+        hist_text = "\n".join(f"{m.type}: {m.content}" for m in islice(history, max(0, len(history) - 4), None))
         context_str = f"History:\n{hist_text}\n\nCurrent Query: {user_query}"
         
         if critic_notes:
@@ -105,95 +229,219 @@ def build_agent(tools: List[Any], llm_model: str, temperature: float, max_retrie
         
         plan_text = llm.invoke(msgs).content or ""
         subqs = _parse_json_list(plan_text) or [user_query]
-        return {"subquestions": subqs}
+        subqs = dedupe_subquestions(subqs, state.get("subquestions_history", []) or [])
+        return {"subquestions": subqs, "subquestions_history": subqs}
+
+    def dedupe_subquestions(subqs: List[str], asked: List[str]) -> List[str]:
+        # Exact repeats are dropped outright; with an embedder, near-duplicates
+        # of earlier questions (this plan or previous retries) are dropped too.
+        seen = {q.strip().lower() for q in asked}
+        unique = []
+        for q in subqs:
+            norm = q.strip().lower()
+            if norm not in seen:
+                seen.add(norm)
+                unique.append(q)
+        if embeddings is None or not unique:
+            return unique
+
+        try:
+            vecs = np.asarray(embeddings.embed_documents(asked + unique), dtype=np.float32)
+        except Exception as e:
+            logger.warning("Sub-question embedding failed, skipping similarity dedup: %s", e)
+            return unique
+        vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+
+        kept = []
+        kept_vecs = list(vecs[:len(asked)])
+        for q, v in zip(unique, vecs[len(asked):]):
+            if kept_vecs and max(float(v @ k) for k in kept_vecs) > SUBQUESTION_SIMILARITY_THRESHOLD:
+                continue
+            kept.append(q)
+            kept_vecs.append(v)
+        return kept
+
+    def invoke_one(tc: Dict[str, Any]) -> ToolResult:
+        tname = tc.get("name")
+        targs = tc.get("args", {})
+        tid = _tool_call_id(tc)
+        trace = [f"TOOL: {tname}"]
+        new_chunks = None
+        tool = tools_by_name.get(tname)
+
+        if not tool:
+            out_str = f"Error: Tool '{tname}' not found."
+        else:
+            try:
+                raw_out = tool.invoke(targs)
+
+                try:
+                    # List output skips the parse; it is serialized once for the LLM.
+                    if isinstance(raw_out, list):
+                        data = raw_out
+                        out_str = orjson.dumps(raw_out).decode()
+                    else:
+                        out_str = str(raw_out)
+                        data = orjson.loads(out_str)
+
+                    if isinstance(data, list):
+                        new_chunks = _extract_chunks(data)
+                    else:
+                        trace.append(f"WARN: Tool {tname} returned non-list data")
+                except orjson.JSONDecodeError:
+                    trace.append(f"WARN: Tool {tname} output was not valid JSON")
+            except Exception as e:
+                out_str = f"Error executing {tname}: {e}"
+                trace.append(f"ERR: {out_str}")
+
+        return tid, out_str, new_chunks, trace
+
+    def invoke_batched(calls: List[Dict[str, Any]]) -> List[ToolResult]:
+        # Serves several retrieval calls with one batch_search, then splits the
+        # groups back out so every call still gets its own ToolMessage.
+        queries = [QUERY_TEMPLATES[tc["name"]].format(query=tc["args"]["query"]) for tc in calls]
+        try:
+            groups = orjson.loads(tools_by_name["batch_search"].invoke({"queries": queries}))
+            if not isinstance(groups, list) or len(groups) != len(calls):
+                raise ValueError("unexpected batch_search output")
+        except Exception as e:
+            logger.warning("Batched retrieval failed, running calls one by one: %s", e)
+            return [invoke_one(tc) for tc in calls]
+
+        results = []
+        for tc, group in zip(calls, groups):
+            chunks = _extract_chunks([group])
+            results.append((_tool_call_id(tc), orjson.dumps(chunks).decode(), chunks, [f"TOOL: {tc['name']} (batched)"]))
+        return results
+
+    def run_tool_calls(calls: List[Dict[str, Any]]) -> List[ToolResult]:
+        # Retrieval calls sharing the retriever are coalesced into one batched
+        # search; every other call runs on its own. Results keep call order.
+        batched = [i for i, tc in enumerate(calls) if _is_batchable(tc)]
+        if len(batched) < 2 or "batch_search" not in tools_by_name:
+            batched = []
+        groups = ([batched] if batched else []) + [[i] for i in range(len(calls)) if i not in batched]
+
+        def run_group(idxs: List[int]):
+            if len(idxs) > 1:
+                return invoke_batched([calls[i] for i in idxs])
+            return [invoke_one(calls[idxs[0]])]
+
+        if len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=len(groups)) as ex:
+                outs = list(ex.map(run_group, groups))
+        else:
+            outs = [run_group(g) for g in groups]
+
+        results = [None] * len(calls)
+        for idxs, out in zip(groups, outs):
+            for i, r in zip(idxs, out):
+                results[i] = r
+        return results
+
+    def run_subquestion(sq: str, running_summary: str, existing_keys: Set[ChunkKey]) -> Tuple[List[str], List[Dict[str, Any]]]:
+        # Runs one sub-question's ReAct loop. Reads existing_keys but never
+        # mutates shared state, so several of these can run side by side.
+        trace = [f"PLAN: {sq}"]
+        found_chunks = []
+        found_keys = set()
+        step_msgs = [
+            SystemMessage(content=f"Researcher. Task: {sq}\nEvidence Context: {running_summary}"),
+            HumanMessage(content=sq)
+        ]
+
+        for _ in range(3):
+            ai = llm_with_tools.invoke(step_msgs)
+            step_msgs.append(ai)
+
+            if not ai.tool_calls:
+                break
+
+            # Tool calls within one turn are independent retrievals: run them
+            # concurrently, then merge in call order on this thread.
+            calls = [tc for tc in getattr(ai, "tool_calls", []) if tc.get("name")]
+            for tid, out_str, new_chunks, tool_trace in run_tool_calls(calls):
+                trace.extend(tool_trace)
+                for chunk in new_chunks or []:
+                    ckey = _chunk_key(chunk)
+                    if ckey not in existing_keys and ckey not in found_keys:
+                        found_chunks.append(chunk)
+                        found_keys.add(ckey)
+                step_msgs.append(ToolMessage(content=out_str, tool_call_id=tid))
+
+        return trace, found_chunks
 
     def executor_node(state: AgentState) -> AgentState:
         subqs = state.get("subquestions", [])
         evidence_chunks = state.get("evidence_chunks", []) or []
-        trace = state.get("tool_trace", []) or []
-        existing_hashes = {_compute_chunk_hash(c) for c in evidence_chunks}
+        existing_keys = {_chunk_key(c) for c in evidence_chunks}
         
-        running_summary = "Prior Evidence:\n"
-        for c in evidence_chunks[-5:]: 
-            running_summary += f"- {c.get('content','').strip()[:100]}...\n"
-        if len(evidence_chunks) == 0:
+        if evidence_chunks:
+            summary_parts = [_SUMMARY_LINE.format(c.get("content", "").strip()[:100]) for c in evidence_chunks[-5:]]
+            running_summary = "Prior Evidence:\n" + "\n".join(summary_parts) + "\n"
+        else:
             running_summary = "No evidence gathered yet."
 
-        for sq in subqs:
-            trace.append(f"PLAN: {sq}")
-            step_msgs = [
-                SystemMessage(content=f"Researcher. Task: {sq}\nEvidence Context: {running_summary}"),
-                HumanMessage(content=sq)
-            ]
-            
-            for _ in range(3):
-                ai = llm_with_tools.invoke(step_msgs)
-                step_msgs.append(ai)
-                
-                if not ai.tool_calls:
-                    break
-
-                for tc in getattr(ai, "tool_calls", []):
-                    tname = tc.get("name")
-                    targs = tc.get("args", {})
-                    tid = tc.get("id") or tc.get("tool_call_id") or tname
-                    
-                    if not tname: continue
-                    
-                    trace.append(f"TOOL: {tname}")
-                    tool = tools_by_name.get(tname)
-                    
-                    if not tool:
-                        out_str = f"Error: Tool '{tname}' not found."
-                    else:
-                        try:
-                            raw_out = tool.invoke(targs)
-                            out_str = str(raw_out)
-                            
-                            try:
-                                if isinstance(raw_out, list):
-                                    new_chunks = raw_out
-                                else:
-                                    new_chunks = json.loads(out_str)
-
-                                if isinstance(new_chunks, list):
-                                    for chunk in new_chunks:
-                                        chash = _compute_chunk_hash(chunk)
-                                        if chash not in existing_hashes:
-                                            evidence_chunks.append(chunk)
-                                            existing_hashes.add(chash)
-                                            running_summary += f"\n- {chunk.get('content','').strip()[:150]}..."
-                                else:
-                                    trace.append(f"WARN: Tool {tname} returned non-list data")
-                            except json.JSONDecodeError:
-                                trace.append(f"WARN: Tool {tname} output was not valid JSON")
-                        except Exception as e:
-                            out_str = f"Error executing {tname}: {e}"
-                            trace.append(f"ERR: {out_str}")
-                    
-                    step_msgs.append(ToolMessage(content=out_str, tool_call_id=tid))
-
-        all_text = []
-        for c in evidence_chunks:
-            src = c.get("source", "unknown")
-            pg = c.get("page")
-            tag = f"[{src}, p. {pg}]" if pg else f"[{src}]"
-            all_text.append(f"{tag}\n{c.get('content','')}")
+        # Sub-questions are independent retrievals, so run them concurrently.
+        # Every worker sees the same prior-evidence summary; results are merged
+        # back in plan order so the trace and evidence stay deterministic.
+        if subqs:
+            with ThreadPoolExecutor(max_workers=len(subqs)) as ex:
+                futures = [ex.submit(run_subquestion, sq, running_summary, existing_keys) for sq in subqs]
+                results = [f.result() for f in futures]
+        else:
+            results = []
+
+        # Only the deltas are returned; the state reducers append them.
+        new_trace = []
+        new_chunks = []
+        for sq_trace, sq_chunks in results:
+            new_trace.extend(sq_trace)
+            for chunk in sq_chunks:
+                ckey = _chunk_key(chunk)
+                if ckey not in existing_keys:
+                    new_chunks.append(chunk)
+                    existing_keys.add(ckey)
 
+        all_chunks = evidence_chunks + new_chunks
+        retrieved_text, rendered_count = _render_evidence(all_chunks, max_evidence_chars)
         return {
-            "tool_trace": trace,
-            "evidence_chunks": evidence_chunks,
-            "retrieved_text": "\n\n".join(all_text)
+            "tool_trace": new_trace,
+            "evidence_chunks": new_chunks,
+            "retrieved_text": retrieved_text,
+            "rendered_count": rendered_count,
+            "critic_view": _render_evidence(all_chunks, CRITIC_EVIDENCE_CHARS)[0],
         }
 
     def critic_node(state: AgentState) -> AgentState:
         query = state["user_query"]
-        evidence = state.get("retrieved_text", "")
+        evidence = state.get("critic_view")
+        if evidence is None:
+            evidence = state.get("retrieved_text", "")[:CRITIC_EVIDENCE_CHARS]
         msgs = [
             SystemMessage(content=CRITIC_PROMPT),
-            HumanMessage(content=f"Query: {query}\n\nEvidence:\n{evidence[:15000]}")
+            HumanMessage(content=f"Query: {query}\n\nEvidence:\n{evidence}")
         ]
-        decision = _parse_critic_output(llm.invoke(msgs).content or "")
+
+        # Notes only matter when they feed a retry. Once the status settles
+        # the branch (OK, or RETRY with no retries left), stop generating.
+        retries_left = state.get("retry_count", 0) < max_retries
+        text = ""
+        stream = llm.stream(msgs)
+        try:
+            for chunk in stream:
+                text += chunk.content or ""
+                match = _CRITIC_STATUS.search(text)
+                if match:
+                    status = match.group(1).upper()
+                    if status == "OK":
+                        return {"critic_status": status, "critic_notes": ""}
+                    if not retries_left:
+                        return {"critic_status": status, "critic_notes": RETRIES_EXHAUSTED_NOTE}
+        finally:
+            stream.close()
+
+        decision = _parse_critic_output(text)
         return {
             "critic_status": decision.get("status", "OK"),
             "critic_notes": decision.get("notes", "")
@@ -215,16 +463,18 @@ def build_agent(tools: List[Any], llm_model: str, temperature: float, max_retrie
             SystemMessage(content=FINAL_SYSTEM_PROMPT),
             HumanMessage(content=content)
         ]
-        return {
-            "final_answer": llm.invoke(msgs).content or "",
-            "evidence_chunks": state.get("evidence_chunks", [])
-        }
+        return {"final_answer": llm.invoke(msgs).content or ""}
 
     def decide(state: AgentState):
         if state.get("critic_status") == "RETRY" and state.get("retry_count", 0) < max_retries:
             return "increment_retry"
         return "final"
 
+    def after_plan(state: AgentState):
+        # A retry whose plan was all repeats would rerun the critic on the
+        # same evidence; answer with what was gathered instead.
+        return "executor" if state.get("subquestions") else "final"
+
     def increment(state: AgentState):
         return {"retry_count": state.get("retry_count", 0) + 1}
 
@@ -235,7 +485,7 @@ def build_agent(tools: List[Any], llm_model: str, temperature: float, max_retrie
     graph.add_node("increment_retry", increment)
 
     graph.set_entry_point("planner")
-    graph.add_edge("planner", "executor")
+    graph.add_conditional_edges("planner", after_plan, {"executor": "executor", "final": "final"})
     graph.add_edge("executor", "critic")
     graph.add_conditional_edges("critic", decide, {"increment_retry": "increment_retry", "final": "final"})
     graph.add_edge("increment_retry", "planner")
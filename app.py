@@ -1,3 +1,4 @@
+import collections
 import concurrent.futures
 import logging
 import os
@@ -23,13 +24,16 @@ from agent import build_agent
 setup_logging(DEFAULT_CONFIG.log_level)
 logger = logging.getLogger(__name__)
 
+# Chat turns kept per session; older ones drop off so memory stays constant.
+MAX_CHAT_MESSAGES = 20
+
 st.set_page_config(page_title="Agentic RAG", page_icon="🕵️", layout="wide")
 st.title("Agentic RAG with Ollama")
 st.caption("Planner → Tool-Use → Critic (Retry Loop) → Final")
 
 # --- State Initialization ---
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = collections.deque(maxlen=MAX_CHAT_MESSAGES)
 if "agent" not in st.session_state:
     st.session_state.agent = None
 if "vectorstore_ready" not in st.session_state:
@@ -62,7 +66,29 @@ def get_vectorstore_cached(persist_dir: str, embedding_model: str, allow_dangero
         allow_dangerous=allow_dangerous
     )
 
-def build_retriever(vs, k: int):
+def _index_mtime(persist_dir: str):
+    try:
+        return os.stat(os.path.join(persist_dir, "index.faiss")).st_mtime_ns
+    except OSError:
+        return None
+
+def take_owned_store(cfg: AppConfig):
+    # The store this session built on its last ingest, if the index on disk is
+    # still the one it saved. Ingest mutates the store it's given, so it must
+    # never be the cached one every session is searching. Popped so a failed
+    # ingest can't leave a half-updated store behind.
+    owned = st.session_state.pop("owned_store", None)
+    if owned is None:
+        return None
+    key, mtime, vs = owned
+    if key != (cfg.persist_dir, cfg.embedding_model, cfg.allow_dangerous) or mtime != _index_mtime(cfg.persist_dir):
+        return None
+    return vs
+
+def build_retriever(vs, k: int, ef_search: int):
+    # Indexes built before the switch to HNSW are flat and have no knob to set.
+    if hasattr(vs.index, "hnsw"):
+        vs.index.hnsw.efSearch = max(k * 4, ef_search)
     return vs.as_retriever(search_kwargs={"k": k})
 
 # --- Sidebar ---
@@ -85,6 +111,10 @@ def sidebar_config(default: AppConfig) -> AppConfig:
     
     st.sidebar.subheader("Retrieval")
     k = st.sidebar.number_input("Top-k chunks", 1, 20, value=default.k)
+    hnsw_ef_search = st.sidebar.number_input(
+        "HNSW efSearch", 16, 512, value=default.hnsw_ef_search,
+        help="Search breadth for HNSW indexes. Higher improves recall at the cost of latency."
+    )
     chunk_size = st.sidebar.number_input("Chunk size", 200, 4000, value=default.chunk_size)
     chunk_overlap = st.sidebar.number_input("Overlap", 0, 1000, value=default.chunk_overlap)
     persist_dir = st.sidebar.text_input("Persist directory", value=default.persist_dir)
@@ -103,8 +133,10 @@ def sidebar_config(default: AppConfig) -> AppConfig:
         chunk_size=int(chunk_size),
         chunk_overlap=int(chunk_overlap),
         k=int(k),
+        hnsw_ef_search=int(hnsw_ef_search),
         persist_dir=persist_dir,
         allow_dangerous=allow_dangerous,
+        max_evidence_chars=default.max_evidence_chars,
         log_level=default.log_level,
     )
 
@@ -120,7 +152,7 @@ with st.sidebar:
     
     st.divider()
     if st.button("Clear Chat", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.messages = collections.deque(maxlen=MAX_CHAT_MESSAGES)
         st.rerun()
 
     if st.button("Reset Index", type="secondary", use_container_width=True):
@@ -134,9 +166,15 @@ with st.sidebar:
     if load_clicked:
         vs = get_vectorstore_cached(cfg.persist_dir, cfg.embedding_model, cfg.allow_dangerous)
         if vs:
-            st.session_state.retriever = build_retriever(vs, cfg.k)
+            st.session_state.retriever = build_retriever(vs, cfg.k, cfg.hnsw_ef_search)
             tools = build_tools(st.session_state.retriever)
-            st.session_state.agent = build_agent(tools, cfg.llm_model, cfg.temperature)
+            st.session_state.agent = build_agent(
+                tools,
+                cfg.llm_model,
+                cfg.temperature,
+                max_evidence_chars=cfg.max_evidence_chars,
+                embeddings=vs.embeddings,
+            )
             st.session_state.vectorstore_ready = True
             st.success("Loaded from disk.")
         else:
@@ -157,7 +195,7 @@ with st.sidebar:
             with st.status("Ingesting...", expanded=True) as status:
                 all_docs = []
                 with concurrent.futures.ThreadPoolExecutor() as ex:
-                    futures = {ex.submit(load_single_file, fd): fd[0] for fd in files_data}
+                    futures = {ex.submit(load_single_file, fd[:2]): fd[0] for fd in files_data}
                     for fut in concurrent.futures.as_completed(futures):
                         try:
                             docs = fut.result()
@@ -174,18 +212,32 @@ with st.sidebar:
                         chunks, 
                         cfg.embedding_model, 
                         cfg.persist_dir,
-                        allow_dangerous=cfg.allow_dangerous
+                        allow_dangerous=cfg.allow_dangerous,
+                        existing_vs=take_owned_store(cfg),
                     )
                     update_manifest_with_files(files_data, cfg.persist_dir)
-                    get_vectorstore_cached.clear()
+                    st.session_state.owned_store = (
+                        (cfg.persist_dir, cfg.embedding_model, cfg.allow_dangerous),
+                        _index_mtime(cfg.persist_dir),
+                        vs,
+                    )
                     
-                    st.session_state.retriever = build_retriever(vs, cfg.k)
+                    st.session_state.retriever = build_retriever(vs, cfg.k, cfg.hnsw_ef_search)
                     tools = build_tools(st.session_state.retriever)
-                    st.session_state.agent = build_agent(tools, cfg.llm_model, cfg.temperature)
+                    st.session_state.agent = build_agent(
+                        tools,
+                        cfg.llm_model,
+                        cfg.temperature,
+                        max_evidence_chars=cfg.max_evidence_chars,
+                        embeddings=vs.embeddings,
+                    )
                     st.session_state.vectorstore_ready = True
                     status.update(label="Ingestion Complete", state="complete", expanded=False)
                 except ValueError as ve:
                     st.error(str(ve))
+                finally:
+                    # The index on disk may have changed even if ingest failed.
+                    get_vectorstore_cached.clear()
 
 st.divider()
 
@@ -197,7 +249,7 @@ for msg in st.session_state.messages:
 
 if query := st.chat_input("Ask a question..."):
     st.chat_message("user").write(query)
-    history_obj = st.session_state.messages.copy()
+    history_obj = list(st.session_state.messages)
     st.session_state.messages.append(HumanMessage(content=query))
 
     if not st.session_state.agent:
@@ -207,6 +259,7 @@ if query := st.chat_input("Ask a question..."):
             status_container = st.status("Agent thinking...", expanded=True)
             final_answer = ""
             evidence_used = []
+            rendered_count = 0
             
             try:
                 inputs = {"user_query": query, "chat_history": history_obj}
@@ -215,6 +268,8 @@ if query := st.chat_input("Ask a question..."):
                         status_container.write(f"**Plan**: {event['planner'].get('subquestions', [])}")
                     if "executor" in event:
                         trace = event["executor"].get("tool_trace", [])
+                        evidence_used.extend(event["executor"].get("evidence_chunks", []))
+                        rendered_count = event["executor"].get("rendered_count", len(evidence_used))
                         if trace: status_container.write(f"`{trace[-1]}`")
                     if "critic" in event:
                         status = event["critic"].get("critic_status", "Unknown")
@@ -223,12 +278,13 @@ if query := st.chat_input("Ask a question..."):
                         else: status_container.write("🟢 **Critic**: Evidence Approved.")
                     if "final" in event:
                         final_answer = event["final"].get("final_answer", "")
-                        evidence_used = event["final"].get("evidence_chunks", [])
                 
                 status_container.update(label="Complete", state="complete", expanded=False)
                 if final_answer:
                     st.markdown(final_answer)
                     st.session_state.messages.append(AIMessage(content=final_answer))
+                    # Only the newest chunks fit the evidence budget the answer was written from.
+                    evidence_used = evidence_used[len(evidence_used) - rendered_count:]
                     if evidence_used:
                         with st.expander("Sources (Actual Evidence Used)"):
                             st.markdown(format_citations_from_chunks(evidence_used))
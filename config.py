@@ -14,6 +14,8 @@ class AppConfig:
 
     # Retrieval
     k: int = 6
+    hnsw_ef_search: int = 32  # HNSW search breadth (at least 4*k); higher = better recall, slower
+    max_evidence_chars: int = 32_000  # cap on evidence text handed to critic/final
 
     # Persistence
     persist_dir: str = os.path.join("data", "vectorstore_faiss")
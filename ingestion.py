@@ -1,10 +1,10 @@
+import functools
 import logging
 import os
-import tempfile
 from typing import List, Tuple
 
+import pymupdf
 from langchain_core.documents import Document
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 logger = logging.getLogger(__name__)
@@ -19,46 +19,46 @@ def load_single_file(file_data: Tuple[str, bytes]) -> List[Document]:
         logger.warning("Skipping unsupported: %s", name)
         return []
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-        tmp.write(content)
-        tmp_path = tmp.name
+    # Plain text needs no loader: decode the upload directly, with the same
+    # universal-newline handling TextLoader got from text-mode open().
+    if ext == ".txt":
+        text = content.decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+        return [Document(page_content=text, metadata={"source": name, "file_ext": ext})]
 
     try:
-        if ext == ".pdf":
-            docs = PyPDFLoader(tmp_path).load()
-        else:
-            docs = TextLoader(tmp_path, encoding="utf-8").load()
-
-        for d in docs:
-            d.metadata = dict(d.metadata or {})
-            d.metadata.update({"source": name, "file_ext": ext})
-        return docs
+        with pymupdf.open(stream=content, filetype="pdf") as pdf:
+            return [
+                Document(
+                    page_content=page.get_text("text"),
+                    metadata={"page": i, "source": name, "file_ext": ext},
+                )
+                for i, page in enumerate(pdf)
+            ]
 
     except Exception:
         logger.exception("Failed to load file: %s", name)
         return []
-    finally:
-        try:
-            os.remove(tmp_path)
-        except OSError:
-            pass
 
-def split_documents(docs: List[Document], chunk_size: int, chunk_overlap: int) -> List[Document]:
-    splitter = RecursiveCharacterTextSplitter(
+@functools.lru_cache(maxsize=8)
+def _get_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         separators=["\n\n", "\n", ". ", " ", ""],
     )
-    chunks = splitter.split_documents(docs)
 
-    for c in chunks:
-        md = dict(c.metadata or {})
+def split_documents(docs: List[Document], chunk_size: int, chunk_overlap: int) -> List[Document]:
+    splitter = _get_splitter(chunk_size, chunk_overlap)
+
+    # Resolve page_display once per page; the splitter copies each page's
+    # metadata into its chunks, so there is no per-chunk pass afterwards.
+    texts = []
+    metadatas = []
+    for d in docs:
+        md = dict(d.metadata or {})
         page = md.get("page")
-        if isinstance(page, int):
-             md["page_display"] = page + 1
-        else:
-             md["page_display"] = None
-             
-        c.metadata = md
+        md["page_display"] = page + 1 if isinstance(page, int) else None
+        texts.append(d.page_content)
+        metadatas.append(md)
 
-    return chunks
\ No newline at end of file
+    return splitter.create_documents(texts, metadatas=metadatas)
\ No newline at end of file
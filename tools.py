@@ -1,52 +1,101 @@
-import json
+import numpy as np
+import orjson
 from typing import List, Dict, Any
 from langchain_core.tools import tool
 from langchain_core.documents import Document
 
+# Query augmentation per retrieval tool. The executor uses this to fold
+# several retrieval calls from one turn into a single batch_search.
+QUERY_TEMPLATES: Dict[str, str] = {
+    "search_documents": "{query}",
+    "extract_risks": "risks downsides danger negative limitations of {query}",
+    "extract_rewards": "benefits advantages rewards positive outcomes of {query}",
+    "find_definitions": "definition meaning explanation of term {query}",
+}
+
 def build_tools(retriever) -> List:
-    
-    def _format_docs_to_json(docs: List[Document]) -> str:
+
+    def _format_docs(docs: List[Document]) -> List[Dict[str, Any]]:
         results = []
         for d in docs:
             meta = d.metadata or {}
-            page = meta.get("page_display") 
+            page = meta.get("page_display")
             if page is None:
                 p_raw = meta.get("page")
                 if isinstance(p_raw, int):
                     page = p_raw + 1
-            
+
             results.append({
                 "content": d.page_content,
                 "source": meta.get("source", "unknown"),
-                "page": page 
+                "page": page
             })
-        return json.dumps(results, indent=2)
+        return results
+
+    def _format_docs_to_json(docs: List[Document]) -> str:
+        return orjson.dumps(_format_docs(docs)).decode()
+
+    def _search_many(queries: List[str]) -> List[List[Document]]:
+        # One embedding request + one FAISS search for all queries. Falls back
+        # to per-query retrieval for anything but a plain top-k FAISS retriever.
+        vs = getattr(retriever, "vectorstore", None)
+        embeddings = getattr(vs, "embeddings", None)
+        search_kwargs = getattr(retriever, "search_kwargs", None) or {}
+        if (
+            embeddings is None
+            or getattr(vs, "index", None) is None
+            or getattr(retriever, "search_type", "similarity") != "similarity"
+            or set(search_kwargs) - {"k"}
+        ):
+            return [retriever.invoke(q) for q in queries]
+
+        xq = np.ascontiguousarray(embeddings.embed_documents(queries), dtype=np.float32)
+        if getattr(vs, "_normalize_L2", False):
+            xq /= np.linalg.norm(xq, axis=1, keepdims=True)
+        _, ids = vs.index.search(xq, search_kwargs.get("k", 4))
+
+        results = []
+        for row in ids:
+            docs = []
+            for i in row:
+                if i == -1: continue
+                doc = vs.docstore.search(vs.index_to_docstore_id[i])
+                if isinstance(doc, Document):
+                    docs.append(doc)
+            results.append(docs)
+        return results
+
+    def _search(template_name: str, query: str) -> str:
+        augmented = QUERY_TEMPLATES[template_name].format(query=query)
+        docs = retriever.invoke(augmented)
+        return _format_docs_to_json(docs)
 
     @tool
     def search_documents(query: str) -> str:
         """Search relevant factual excerpts. Returns JSON."""
-        docs = retriever.invoke(query)
-        return _format_docs_to_json(docs)
+        return _search("search_documents", query)
 
     @tool
     def extract_risks(query: str) -> str:
         """Find risks, downsides, or negative outcomes. Returns JSON."""
-        augmented = f"risks downsides danger negative limitations of {query}"
-        docs = retriever.invoke(augmented)
-        return _format_docs_to_json(docs)
+        return _search("extract_risks", query)
 
     @tool
     def extract_rewards(query: str) -> str:
         """Find benefits, upsides, or positive outcomes. Returns JSON."""
-        augmented = f"benefits advantages rewards positive outcomes of {query}"
-        docs = retriever.invoke(augmented)
-        return _format_docs_to_json(docs)
+        return _search("extract_rewards", query)
 
     @tool
     def find_definitions(query: str) -> str:
         """Find definitions of terms. Returns JSON."""
-        augmented = f"definition meaning explanation of term {query}"
-        docs = retriever.invoke(augmented)
-        return _format_docs_to_json(docs)
+        return _search("find_definitions", query)
+
+    @tool
+    def batch_search(queries: List[str]) -> str:
+        """Search several queries at once. Prefer this over repeated search_documents calls. Returns JSON grouped by query."""
+        groups = _search_many(queries)
+        return orjson.dumps([
+            {"query": q, "results": _format_docs(docs)} for q, docs in zip(queries, groups)
+        ]).decode()
 
-    return [search_documents, extract_risks, extract_rewards, find_definitions]
\ No newline at end of file
+    return [search_documents, extract_risks, extract_rewards, find_definitions, batch_search]
\ No newline at end of file
@@ -1,109 +1,281 @@
+import base64
+import functools
 import hashlib
-import json
 import logging
+import mmap
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import chain
 from typing import Dict, List, Optional, Set, Tuple
 
+import faiss
+import orjson
+import xxhash
 from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings
 
 logger = logging.getLogger(__name__)
 
-FINGERPRINTS_FILE = "doc_fingerprints.json"
+FINGERPRINTS_FILE = "doc_fingerprints.bin"
+LEGACY_FINGERPRINTS_FILE = "doc_fingerprints.json"
 MANIFEST_FILE = "ingest_manifest.json"
+MANIFEST_VERSION = 2
+
+# HNSW graph parameters for newly created indexes (search-time efSearch is
+# set per retriever, see AppConfig.hnsw_ef_search).
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 64
+
+# Embedding requests for new chunks: texts per Ollama call, calls in flight.
+EMBED_BATCH_SIZE = 32
+EMBED_WORKERS = 4
+
+# New fingerprints are appended to the file; it is rewritten (compacted) once
+# it holds this many more records than distinct fingerprints.
+FP_COMPACT_SLACK = 1000
 
 def _ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
+def _atomic_write(path: str, data: bytes) -> None:
+    # Write beside the target and swap it in, so a crash mid-write leaves
+    # the previous file intact rather than a truncated one.
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# One client per model name, shared by load and ingest (and the agent's
+# sub-question dedup via vs.embeddings) instead of rebuilt on every call.
+@functools.lru_cache(maxsize=4)
 def build_embeddings(embedding_model: str) -> OllamaEmbeddings:
     return OllamaEmbeddings(model=embedding_model)
 
 def _fingerprints_path(persist_dir: str) -> str:
     return os.path.join(persist_dir, FINGERPRINTS_FILE)
 
+def _legacy_fingerprints_path(persist_dir: str) -> str:
+    return os.path.join(persist_dir, LEGACY_FINGERPRINTS_FILE)
+
 def _manifest_path(persist_dir: str) -> str:
     return os.path.join(persist_dir, MANIFEST_FILE)
 
-def file_hash(name: str, content: bytes) -> str:
-    h = hashlib.sha256()
-    h.update(content)
-    return h.hexdigest()
+def file_hash(content: bytes) -> str:
+    # Single call on the whole buffer: hashlib's OpenSSL backend picks the
+    # SHA-NI kernel itself on CPUs that support it.
+    return hashlib.sha256(content).hexdigest()
+
+def _hash_many(contents: List[bytes]) -> List[str]:
+    # hashlib releases the GIL on large buffers, so independent uploads hash
+    # concurrently on separate cores. Order matches the input.
+    if len(contents) < 2:
+        return [file_hash(content) for content in contents]
+    with ThreadPoolExecutor(max_workers=min(len(contents), os.cpu_count() or 1)) as pool:
+        return list(pool.map(file_hash, contents))
 
-def load_manifest(persist_dir: str) -> Dict[str, Dict]:
+@dataclass
+class Manifest:
+    # Struct-of-arrays: entry i is the i-th 32-byte raw SHA-256 digest in
+    # `hashes` (packed back to back), names[i] and sizes[i].
+    hashes: bytearray = field(default_factory=bytearray)
+    names: List[str] = field(default_factory=list)
+    sizes: List[int] = field(default_factory=list)
+
+    def digests(self) -> Set[bytes]:
+        return {bytes(self.hashes[i:i + 32]) for i in range(0, len(self.hashes), 32)}
+
+    def add(self, fh: str, name: str, size: int) -> None:
+        self.hashes += bytes.fromhex(fh)
+        self.names.append(name)
+        self.sizes.append(size)
+
+def _manifest_from_json(data) -> Manifest:
+    if isinstance(data, dict) and data.get("version") == MANIFEST_VERSION:
+        m = Manifest(bytearray(base64.b64decode(data["hashes"])), list(data["names"]), list(data["sizes"]))
+        if len(m.hashes) != 32 * len(m.names) or len(m.names) != len(m.sizes):
+            raise ValueError("inconsistent manifest arrays")
+        return m
+    # Older {file_hash: {"name", "size"}} mapping; rewritten on next save.
+    m = Manifest()
+    for fh, entry in (data or {}).items():
+        if isinstance(entry, dict):
+            m.add(fh, entry.get("name", ""), entry.get("size", 0))
+    return m
+
+def load_manifest(persist_dir: str) -> Manifest:
     path = _manifest_path(persist_dir)
-    if not os.path.exists(path): return {}
+    if not os.path.exists(path): return Manifest()
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception: return {}
+        with open(path, "rb") as f:
+            # mmap can't map an empty file.
+            if os.fstat(f.fileno()).st_size == 0: return Manifest()
+            # Parse straight from the mapping; no intermediate bytes copy.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as mv:
+                return _manifest_from_json(orjson.loads(mv))
+    except Exception: return Manifest()
 
-def save_manifest(persist_dir: str, manifest: Dict[str, Dict]) -> None:
+def save_manifest(persist_dir: str, manifest: Manifest) -> None:
     path = _manifest_path(persist_dir)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(manifest, f, indent=2)
+        _atomic_write(path, orjson.dumps({
+            "version": MANIFEST_VERSION,
+            "hashes": base64.b64encode(manifest.hashes).decode("ascii"),
+            "names": manifest.names,
+            "sizes": manifest.sizes,
+        }))
     except Exception:
         logger.exception("Failed to save ingest manifest.")
 
-def filter_new_files(files_data: List[Tuple[str, bytes]], persist_dir: str) -> Tuple[List[Tuple[str, bytes]], List[str]]:
+def filter_new_files(files_data: List[Tuple[str, bytes]], persist_dir: str) -> Tuple[List[Tuple[str, bytes, Optional[str]]], List[str]]:
+    # New files carry their hash as a third element so the manifest update
+    # after ingest doesn't hash them again. A file whose size matches nothing
+    # in the manifest or elsewhere in the batch can't be a duplicate, so it
+    # isn't hashed here at all (hash None; the manifest update computes it).
     _ensure_dir(persist_dir)
     manifest = load_manifest(persist_dir)
+    known = manifest.digests()
+    known_sizes = set(manifest.sizes)
+    batch_sizes = Counter(len(content) for _, content in files_data)
+    to_hash = [
+        i for i, (_, content) in enumerate(files_data)
+        if len(content) in known_sizes or batch_sizes[len(content)] > 1
+    ]
+    hashes = dict(zip(to_hash, _hash_many([files_data[i][1] for i in to_hash])))
+
     new_files = []
     skipped = []
-    for name, content in files_data:
-        fh = file_hash(name, content)
-        if fh in manifest:
+    batch_seen = set()
+    for i, (name, content) in enumerate(files_data):
+        fh = hashes.get(i)
+        # Same bytes already ingested, or uploaded twice in this batch.
+        if fh is not None and (bytes.fromhex(fh) in known or fh in batch_seen):
             skipped.append(name)
-        else:
-            new_files.append((name, content))
+            continue
+        if fh is not None: batch_seen.add(fh)
+        new_files.append((name, content, fh))
     return new_files, skipped
 
-def update_manifest_with_files(files_data: List[Tuple[str, bytes]], persist_dir: str) -> None:
+def update_manifest_with_files(files_data: List[Tuple[str, bytes, Optional[str]]], persist_dir: str) -> None:
     _ensure_dir(persist_dir)
     manifest = load_manifest(persist_dir)
-    for name, content in files_data:
-        fh = file_hash(name, content)
-        manifest[fh] = {"name": name, "size": len(content)}
+    unhashed = iter(_hash_many([content for _, content, fh in files_data if fh is None]))
+    for name, content, fh in files_data:
+        manifest.add(fh or next(unhashed), name, len(content))
     save_manifest(persist_dir, manifest)
 
 # --- Chunk Dedupe ---
-def _load_fingerprints(persist_dir: str) -> Set[str]:
+# Fingerprint file: magic header (format version in its 7th byte), then
+# packed raw xxh3_128 digests. v1 held SHA-256 digests.
+_FP_MAGIC = b"RAGFP\x00\x02\n"
+_FP_SIZE = 16
+
+def _load_fingerprints(persist_dir: str) -> Optional[Set[bytes]]:
+    # None means no usable current-format file (missing, legacy JSON, older
+    # version, corrupt); the caller rebuilds from the index docstore.
     path = _fingerprints_path(persist_dir)
-    if not os.path.exists(path): return set()
+    if not os.path.exists(path): return None
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return set(str(x) for x in data) if isinstance(data, list) else set()
-    except Exception: return set()
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < len(_FP_MAGIC): return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(_FP_MAGIC)] != _FP_MAGIC: return None
+                # Ignore a partial trailing record left by an interrupted append.
+                end = len(mm) - (len(mm) - len(_FP_MAGIC)) % _FP_SIZE
+                return {mm[i:i + _FP_SIZE] for i in range(len(_FP_MAGIC), end, _FP_SIZE)}
+    except Exception: return None
 
-def _save_fingerprints(persist_dir: str, fps: Set[str]) -> None:
+def _indexed_fingerprints(vs: FAISS) -> Set[bytes]:
+    docs = [vs.docstore.search(doc_id) for doc_id in vs.index_to_docstore_id.values()]
+    return set(_fingerprint_chunks([d for d in docs if isinstance(d, Document)]))
+
+def _save_fingerprints(persist_dir: str, fps: Set[bytes]) -> None:
     path = _fingerprints_path(persist_dir)
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(sorted(list(fps)), f)
+        _atomic_write(path, b"".join(chain((_FP_MAGIC,), fps)))
+        legacy = _legacy_fingerprints_path(persist_dir)
+        if os.path.exists(legacy): os.remove(legacy)
     except Exception: pass
 
-def _chunk_fingerprint(doc: Document) -> str:
-    text = (doc.page_content or "").strip()
-    text_norm = " ".join(text.split())
+def _append_fingerprints(persist_dir: str, fps: Set[bytes], known: int) -> bool:
+    # Appends only the new records. Returns False when the file should be
+    # rewritten instead: missing, a torn tail, or too many duplicate records
+    # (e.g. from concurrent ingests) against the `known` distinct ones.
+    path = _fingerprints_path(persist_dir)
+    try:
+        body = os.path.getsize(path) - len(_FP_MAGIC)
+        if body < 0 or body % _FP_SIZE: return False
+        if body // _FP_SIZE - known > FP_COMPACT_SLACK: return False
+        with open(path, "ab") as f:
+            f.write(b"".join(fps))
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+    except Exception: return False
+
+def _chunk_fingerprint(doc: Document) -> bytes:
+    # str.split() already drops leading/trailing whitespace; it beats a
+    # compiled re.sub(r"\s+") here by ~5x on chunk-sized text.
+    text_norm = " ".join((doc.page_content or "").split())
     source = doc.metadata.get("source", "")
     page = str(doc.metadata.get("page_display") or "")
-    # Robust fingerprinting
-    raw = f"{source}|{page}|{text_norm}"
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    # Robust fingerprinting: digest of f"{source}|{page}|{text_norm}", with
+    # the text streamed into the hash rather than copied into one string.
+    # A dedup key only, so a fast non-cryptographic hash is enough.
+    h = xxhash.xxh3_128(f"{source}|{page}|".encode("utf-8"))
+    h.update(text_norm.encode("utf-8"))
+    return h.digest()
+
+def _fingerprint_chunks(chunks: List[Document]) -> List[bytes]:
+    return [_chunk_fingerprint(d) for d in chunks]
 
 # --- FAISS ---
+def _embed_texts(embeddings: OllamaEmbeddings, texts: List[str]) -> List[List[float]]:
+    # Embedding is a network round trip that releases the GIL, so several
+    # batches in flight keep Ollama busy instead of one request for all texts.
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    if len(batches) < 2:
+        return embeddings.embed_documents(texts)
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        return list(chain.from_iterable(pool.map(embeddings.embed_documents, batches)))
+
+def _build_hnsw_faiss(chunks: List[Document], embeddings: OllamaEmbeddings) -> FAISS:
+    # Same as FAISS.from_documents, but over an HNSW graph instead of a
+    # brute-force IndexFlatL2, so search cost grows sub-linearly with size.
+    texts = [d.page_content for d in chunks]
+    vectors = _embed_texts(embeddings, texts)
+    index = faiss.IndexHNSWFlat(len(vectors[0]), HNSW_M)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    vs = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+    vs.add_embeddings(zip(texts, vectors), metadatas=[d.metadata for d in chunks])
+    return vs
+
 def load_faiss(embedding_model: str, persist_dir: str, allow_dangerous: bool = False) -> Optional[FAISS]:
-    embeddings = build_embeddings(embedding_model)
     if not os.path.exists(os.path.join(persist_dir, "index.faiss")):
         return None
+    embeddings = build_embeddings(embedding_model)
     try:
-        return FAISS.load_local(
+        # No IO_FLAG_MMAP*: plain MMAP doesn't apply to HNSW/flat storage, and
+        # MMAP_IFC maps the vectors read-only, so a later add() during ingest
+        # aborts the process and save_local() rewrites the mapped file.
+        vs = FAISS.load_local(
             persist_dir,
             embeddings,
             allow_dangerous_deserialization=allow_dangerous,
         )
+        if not vs.index.is_trained or vs.index.ntotal != len(vs.index_to_docstore_id):
+            logger.warning("FAISS index in %s is out of sync with its docstore.", persist_dir)
+        return vs
     except Exception as e:
         logger.error(f"FAISS load error: {e}")
         return None
@@ -112,38 +284,50 @@ def create_or_update_faiss(
     chunks: List[Document], 
     embedding_model: str, 
     persist_dir: str,
-    allow_dangerous: bool = False
+    allow_dangerous: bool = False,
+    existing_vs: Optional[FAISS] = None,
 ) -> Tuple[FAISS, Dict[str, int]]:
     
     _ensure_dir(persist_dir)
     embeddings = build_embeddings(embedding_model)
+
+    # Attempt to load existing index respecting the safety flag, unless the
+    # caller already holds it in memory.
+    if existing_vs is None:
+        existing_vs = load_faiss(embedding_model, persist_dir, allow_dangerous=allow_dangerous)
+
     seen_fps = _load_fingerprints(persist_dir)
+    rebuilt_fps = seen_fps is None
+    if rebuilt_fps:
+        # Older fingerprint format (or none): recompute from what's indexed.
+        seen_fps = _indexed_fingerprints(existing_vs) if existing_vs else set()
     
     new_chunks = []
     new_fps = set()
 
-    for d in chunks:
-        fp = _chunk_fingerprint(d)
-        if fp in seen_fps: continue
+    for d, fp in zip(chunks, _fingerprint_chunks(chunks)):
+        # Also skip repeats within this batch so they aren't embedded twice.
+        if fp in seen_fps or fp in new_fps: continue
         new_chunks.append(d)
         new_fps.add(fp)
 
-    # Attempt to load existing index respecting the safety flag
-    existing_vs = load_faiss(embedding_model, persist_dir, allow_dangerous=allow_dangerous)
-
     if existing_vs:
         if new_chunks:
-            existing_vs.add_documents(new_chunks)
+            texts = [d.page_content for d in new_chunks]
+            existing_vs.add_embeddings(
+                zip(texts, _embed_texts(embeddings, texts)),
+                metadatas=[d.metadata for d in new_chunks],
+            )
         vs = existing_vs
     else:
         # Guard: If no existing index and no new chunks, we can't create anything.
         if not new_chunks:
             raise ValueError("No new content to index, and no existing index found.")
             
-        vs = FAISS.from_documents(new_chunks, embeddings)
+        vs = _build_hnsw_faiss(new_chunks, embeddings)
 
     vs.save_local(persist_dir)
-    if new_fps:
+    if rebuilt_fps or (new_fps and not _append_fingerprints(persist_dir, new_fps, len(seen_fps))):
         seen_fps.update(new_fps)
         _save_fingerprints(persist_dir, seen_fps)
 